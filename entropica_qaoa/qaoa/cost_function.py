@@ -21,7 +21,6 @@ vqe/cost_functions and change only the QAOA specific details.
 
 from typing import Union, List, Type, Dict, Iterable
 import numpy as np
-from copy import deepcopy
 
 from pyquil import Program
 from pyquil.quil import MemoryReference, QubitPlaceholder, Qubit
@@ -33,7 +32,8 @@ from pyquil.api._quantum_computer import QuantumComputer
 
 from entropica_qaoa.vqe.cost_function import (PrepareAndMeasureOnQVM,
                                               PrepareAndMeasureOnWFSim,
-                                              LogEntry)
+                                              LogEntry,
+                                              _copy_params)
 from entropica_qaoa.qaoa.parameters import AbstractParams
 
 
@@ -279,7 +279,7 @@ class QAOACostFunctionOnWFSim(PrepareAndMeasureOnWFSim):
         # remove last entry from the log and replace it with something
         # immutable
         try:
-            self.log[-1] = LogEntry(x=deepcopy(params),
+            self.log[-1] = LogEntry(x=_copy_params(params),
                                     fun=self.log[-1].fun)
         except AttributeError:
             pass
@@ -371,7 +371,7 @@ class QAOACostFunctionOnQVM(PrepareAndMeasureOnQVM):
         # be in the form of the QAOA parameter class being used, then add to the
         # log
         try:
-            self.log[-1] = LogEntry(x=deepcopy(params),
+            self.log[-1] = LogEntry(x=_copy_params(params),
                                     fun=self.log[-1].fun)
         except AttributeError:
             pass
@@ -11,7 +11,8 @@ from pyquil.gates import RX, RY, X
 from pyquil.paulis import PauliSum, PauliTerm
 
 from entropica_qaoa.vqe.cost_function import (PrepareAndMeasureOnWFSim,
-                                              PrepareAndMeasureOnQVM)
+                                              PrepareAndMeasureOnQVM,
+                                              _hamiltonian_cache_key)
 
 
 def test_PrepareAndMeasureOnWFSim():
@@ -40,6 +41,44 @@ def test_PrepareAndMeasureOnWFSim():
     assert np.allclose(out, (-1, 0.0))
 
 
+def test_PrepareAndMeasureOnWFSim_batch():
+    p = Program()
+    params = p.declare("params", memory_type="REAL", memory_size=2)
+    p.inst(RX(params[0], 0))
+    p.inst(RX(params[1], 1))
+
+    ham = PauliSum([PauliTerm("Z", 0), PauliTerm("Z", 1)])
+    sim = WavefunctionSimulator()
+    cost_fn = PrepareAndMeasureOnWFSim(p,
+                                       lambda p: {"params": p},
+                                       ham,
+                                       sim,
+                                       nshots=0)
+    params_list = [[np.pi, np.pi / 2], [np.pi / 2, 0], [0, 0]]
+    out = cost_fn.batch(params_list)
+    assert np.allclose(out, [cost_fn(params) for params in params_list])
+
+
+def test_PrepareAndMeasureOnWFSim_bound_ansatz():
+    p = Program()
+    params = p.declare("params", memory_type="REAL", memory_size=2)
+    p.inst(RX(params[0], 0))
+    p.inst(RX(params[1], 1))
+
+    ham = PauliSum([PauliTerm("Z", 0), PauliTerm("Z", 1)])
+    sim = WavefunctionSimulator()
+    cost_fn = PrepareAndMeasureOnWFSim(p,
+                                       lambda p: {"params": p},
+                                       ham,
+                                       sim)
+    # updating the bound program in place must produce the same quil as
+    # passing a memory map to the simulator on every call
+    cost_fn._update_memory({"params": [np.pi, np.pi / 2]})
+    reference = WavefunctionSimulator.augment_program_with_memory_values(
+        p, {"params": [np.pi, np.pi / 2]})
+    assert cost_fn._bound_ansatz.out() == reference.out()
+
+
 def test_PrepareAndMeasureOnWFSim_QubitPlaceholders():
     q1, q2 = QubitPlaceholder(), QubitPlaceholder()
     p = Program()
@@ -63,6 +102,22 @@ def test_PrepareAndMeasureOnWFSim_QubitPlaceholders():
     assert np.allclose(out, (-1, 0.0))
 
 
+def test_hamiltonian_cache_key():
+    ham1 = PauliSum([PauliTerm("Z", 0), PauliTerm("X", 1, 0.5)])
+    ham2 = PauliSum([PauliTerm("X", 1, 0.5), PauliTerm("Z", 0)])
+    ham3 = PauliSum([PauliTerm("Z", 0), PauliTerm("X", 1, -0.5)])
+    # the key must not depend on the order of the terms, but must pick
+    # up changed coefficients
+    assert _hamiltonian_cache_key(ham1) == _hamiltonian_cache_key(ham2)
+    assert _hamiltonian_cache_key(ham1) != _hamiltonian_cache_key(ham3)
+
+    # PauliSum doesn't simplify on construction, so duplicated terms
+    # are a distinct hamiltonian
+    ham4 = PauliSum([PauliTerm("Z", 0), PauliTerm("Z", 0),
+                     PauliTerm("X", 1, 0.5)])
+    assert _hamiltonian_cache_key(ham1) != _hamiltonian_cache_key(ham4)
+
+
 def test_PrepareAndMeasureOnQVM():
     prepare_ansatz = Program()
     param_register = prepare_ansatz.declare(
@@ -14,7 +14,11 @@ from entropica_qaoa.vqe.measurelib import (append_measure_register,
                                            commuting_decomposition,
                                            base_change_fun,
                                            kron_eigs,
-                                           wavefunction_expectation)
+                                           wavefunction_expectation,
+                                           pauli_mask_terms,
+                                           apply_hamiltonian_masks,
+                                           make_hamiltonian_kernel,
+                                           wavefunction_expectation_masks)
 
 
 def test_commuting_decomposition():
@@ -91,6 +95,67 @@ def test_kron_diagonal():
     assert np.allclose(diag1, diag2)
 
 
+def test_wavefunction_expectation_masks():
+    term1 = PauliTerm("Z", 1, .2) * PauliTerm("Z", 2)
+    term2 = PauliTerm("X", 1, -.4) * PauliTerm("Z", 3)
+    term3 = PauliTerm("Y", 1, 1.4)
+    ham = PauliSum([term1, term2, term3])
+    ham2 = ham * ham
+
+    mat = lifted_pauli(ham, [1, 3, 2])
+    mat2 = lifted_pauli(ham2, [1, 3, 2])
+    wf = (np.array([0, 1.0, 2, .3, .5, -.5, .6, -.9])
+          + 1j * np.array([.4, 0, -.7, 1.0, 0, .3, -.2, .8]))
+
+    e1 = wavefunction_expectation_masks(pauli_mask_terms(ham, [1, 3, 2]), wf)
+    s1 = wavefunction_expectation_masks(pauli_mask_terms(ham2, [1, 3, 2]), wf)
+    e2, s2 = wf.conj()@mat@wf, wf.conj()@mat2@wf
+    assert np.allclose((e1, s1), (e2, s2))
+
+    # single precision input should stay within ~1e-5 of the double
+    # precision result
+    e_single = wavefunction_expectation_masks(
+        pauli_mask_terms(ham, [1, 3, 2]), wf.astype(np.complex64))
+    assert np.abs(e_single - e1) < 1e-5
+
+
+def test_apply_hamiltonian_masks():
+    term1 = PauliTerm("Z", 1, .2) * PauliTerm("Z", 2)
+    term2 = PauliTerm("X", 1, -.4) * PauliTerm("Z", 3)
+    term3 = PauliTerm("Y", 1, 1.4)
+    ham = PauliSum([term1, term2, term3])
+
+    mat = lifted_pauli(ham, [1, 3, 2])
+    wf = (np.array([0, 1.0, 2, .3, .5, -.5, .6, -.9])
+          + 1j * np.array([.4, 0, -.7, 1.0, 0, .3, -.2, .8]))
+
+    terms = pauli_mask_terms(ham, [1, 3, 2])
+    assert np.allclose(apply_hamiltonian_masks(terms, wf), mat@wf)
+    assert np.allclose(apply_hamiltonian_masks(terms,
+                                               wf.astype(np.complex64)),
+                       mat@wf, atol=1e-6)
+
+
+def test_make_hamiltonian_kernel():
+    term1 = PauliTerm("Z", 1, .2) * PauliTerm("Z", 2)
+    term2 = PauliTerm("X", 1, -.4) * PauliTerm("Z", 3)
+    term3 = PauliTerm("Y", 1, 1.4)
+    ham = PauliSum([term1, term2, term3])
+
+    mat = lifted_pauli(ham, [1, 3, 2])
+    wf = (np.array([0, 1.0, 2, .3, .5, -.5, .6, -.9])
+          + 1j * np.array([.4, 0, -.7, 1.0, 0, .3, -.2, .8]))
+
+    terms = pauli_mask_terms(ham, [1, 3, 2])
+    apply_ham = make_hamiltonian_kernel(terms, 3)
+    assert np.allclose(apply_ham(wf), mat@wf)
+
+    apply_ham_single = make_hamiltonian_kernel(terms, 3, dtype=np.complex64)
+    out = apply_ham_single(wf.astype(np.complex64))
+    assert out.dtype == np.complex64
+    assert np.allclose(out, mat@wf, atol=1e-6)
+
+
 def test_wavefunction_expectation():
     term1 = PauliTerm("Z", 1, .2) * PauliTerm("Z", 2)
     term2 = PauliTerm("X", 1, -.4) * PauliTerm("Z", 3)
@@ -17,25 +17,105 @@ Different cost functions for VQE and one abstract template.
 """
 from typing import Callable, Iterable, Union, List, Dict, Tuple
 import numpy as np
-from collections import namedtuple
-from copy import deepcopy
-import warnings
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy, deepcopy
 
 from pyquil.paulis import PauliSum, PauliTerm
 from pyquil.quil import Program, Qubit, QubitPlaceholder, address_qubits
+from pyquil.quilatom import MemoryReference
+from pyquil.quilbase import Declare
+from pyquil.gates import MOVE
 from pyquil.wavefunction import Wavefunction
 from pyquil.api import WavefunctionSimulator, QuantumComputer, get_qc
 
 from entropica_qaoa.vqe.measurelib import (append_measure_register,
                                            commuting_decomposition,
                                            sampling_expectation,
-                                           kron_eigs,
-                                           base_change_fun,
-                                           wavefunction_expectation)
+                                           pauli_mask_terms,
+                                           make_hamiltonian_kernel)
 
 
 LogEntry = namedtuple("LogEntry", ['x', 'fun'])
 
+# Module level caches, so that rebuilding a cost function with the same
+# hamiltonian and programs (e.g. when sweeping optimizer starting points
+# in a notebook) doesn't pay for the commuting decomposition and the
+# compilation again. Bounded, so sweeping over many distinct
+# hamiltonians doesn't accumulate executables forever.
+_CACHE_MAXSIZE = 64
+_decomposition_cache = {}
+_compile_cache = {}
+
+
+def _cache_insert(cache: Dict, key, value):
+    """Insert ``key: value`` into ``cache``, evicting the oldest entries
+    so that it never holds more than ``_CACHE_MAXSIZE`` items."""
+    cache[key] = value
+    while len(cache) > _CACHE_MAXSIZE:
+        del cache[next(iter(cache))]
+
+
+def _hamiltonian_cache_key(ham: PauliSum) -> frozenset:
+    """A hashable, term-order independent key identifying ``ham``."""
+    # count the terms instead of collecting them in a plain frozenset:
+    # PauliSum doesn't simplify on construction, so duplicated terms are
+    # legal and must not hash like their simplified sum
+    return frozenset(Counter((term.coefficient, term.operations_as_set())
+                             for term in ham).items())
+
+
+def _copy_params(params) -> Union[np.array, object]:
+    """Copy ``params`` for the function call log.
+
+    ``np.array`` copies numeric parameters an order of magnitude faster
+    than ``deepcopy``, which dominates the call overhead for small
+    hamiltonians. Anything non-numeric (e.g. the QAOA parameter objects)
+    still gets deepcopied.
+    """
+    if isinstance(params, np.ndarray):
+        return params.copy()
+    try:
+        return np.array(params, dtype=float)
+    except (TypeError, ValueError):
+        return deepcopy(params)
+
+
+def _bind_memory_references(program: Program) -> Tuple[Program, Dict]:
+    """Prepend ``MOVE`` instructions for all declared memory regions.
+
+    Returns the new program together with a lookup table from
+    ``(region_name, offset)`` to the ``MOVE`` instructions. Updating these
+    ``MOVE`` instructions in place and re-running the returned program is
+    equivalent to passing a ``memory_map`` to
+    ``WavefunctionSimulator.wavefunction``, but doesn't rebuild and
+    re-percolate the whole program on every call.
+
+    Parameters
+    ----------
+    program:
+        The parametric program to bind.
+
+    Returns
+    -------
+    Tuple[Program, Dict]:
+        The bound program and the ``MOVE`` lookup table.
+    """
+    declares = [instr for instr in program if isinstance(instr, Declare)]
+    rest = [instr for instr in program if not isinstance(instr, Declare)]
+
+    moves = {}
+    for declare in declares:
+        for offset in range(declare.memory_size):
+            moves[(declare.name, offset)] =\
+                MOVE(MemoryReference(declare.name, offset), 0.0)
+
+    bound = program.copy_everything_except_instructions()
+    bound += declares
+    bound += list(moves.values())
+    bound += rest
+    return bound, moves
+
 
 class AbstractCostFunction():
     """Template class for cost_functions that are passed to the optimizer
@@ -120,8 +200,24 @@ class PrepareAndMeasureOnWFSim(AbstractCostFunction):
         A mapping to fix QubitPlaceholders to physical qubits. E.g.
         pyquil.quil.get_default_qubit_mapping(program) gives you on.
     hamiltonian_is_diagonal:
-        Pass true, if the hamiltonian contains only Z terms and products
-        thereof. This speeds up __init__ considerably. Defaults to False.
+        Deprecated and ignored. The expectation value is computed directly
+        from the Pauli terms now, which makes ``__init__`` fast either way.
+        Kept for backward compatibility.
+    precision:
+        ``"double"`` (the default) evaluates the expectation values in
+        complex128. ``"single"`` casts the wavefunction to complex64
+        first, which halves the memory traffic of the expectation value
+        at ~1e-7 relative accuracy.
+    fast_memory_key:
+        If all parameters live in a single memory region (i.e.
+        ``make_memory_map`` would return ``{"params": params}``), pass
+        that region name here to write the parameters directly, without
+        building a memory map on every call.
+    use_gpu:
+        If ``True``, evaluate the hamiltonian kernel on a GPU via cupy.
+        Worth it for large qubit counts, where the expectation value
+        dominates over copying the wavefunction to the device. Requires
+        cupy to be installed. Defaults to ``False``.
     """
 
     def __init__(self,
@@ -134,11 +230,18 @@ class PrepareAndMeasureOnWFSim(AbstractCostFunction):
                  enable_logging: bool = False,
                  qubit_mapping: Dict[QubitPlaceholder,
                                      Union[Qubit, int]] = None,
-                 hamiltonian_is_diagonal: bool =False):
+                 hamiltonian_is_diagonal: bool =False,
+                 precision: str = "double",
+                 fast_memory_key: str = None,
+                 use_gpu: bool = False):
 
         self.scalar = scalar_cost_function
         self.nshots = nshots
         self.make_memory_map = make_memory_map
+        if precision not in ("single", "double"):
+            raise ValueError("precision must be 'single' or 'double'")
+        self.wf_dtype = np.complex64 if precision == "single"\
+            else np.complex128
 
         if sim is None:
             sim = WavefunctionSimulator()
@@ -153,24 +256,31 @@ class PrepareAndMeasureOnWFSim(AbstractCostFunction):
             self.prepare_ansatz = prepare_ansatz
             ham = hamiltonian
 
-        qubits = list(self.prepare_ansatz.get_qubits())
-        with warnings.catch_warnings():   # supress commutation warnings
-            warnings.simplefilter("ignore")
-            ham_squared = ham * ham
-        # decompose the hamiltonian in simultaneously measurable parts
-        if not hamiltonian_is_diagonal:
-            hams = commuting_decomposition(ham)
-            hams_squared = commuting_decomposition(ham_squared)
+        # Bind the memory values into a reusable copy of the ansatz once,
+        # so __call__ only updates the MOVE instructions in place instead
+        # of rebuilding the whole program on every evaluation.
+        self._bound_ansatz, self._memory_moves =\
+            _bind_memory_references(self.prepare_ansatz)
+
+        self.fast_memory_key = fast_memory_key
+        if fast_memory_key is not None:
+            self._fast_moves = [move for (name, _), move
+                                in sorted(self._memory_moves.items())
+                                if name == fast_memory_key]
         else:
-            hams = [ham]
-            hams_squared = [ham_squared]
-        # get eigenvalues of each term in the decompsition and base changes
-        self.hams_eigs = [kron_eigs(ham, qubits) for ham in hams]
-        self.hams_squared_eigs = [kron_eigs(ham, qubits)
-                                  for ham in hams_squared]
-        self.base_changes = [base_change_fun(ham, qubits) for ham in hams]
-        self.base_changes_squared = [base_change_fun(ham, qubits)
-                                     for ham in hams_squared]
+            self._fast_moves = None
+
+        qubits = list(self.prepare_ansatz.get_qubits())
+        # represent the hamiltonian via index masks. Each term is then a
+        # single strided pass over the wavefunction, so no commuting
+        # decomposition or base changes are needed. The kernel applying
+        # it is specialized to this hamiltonian, with all phase tables
+        # and gather indices precomputed.
+        self.ham_terms = pauli_mask_terms(ham, qubits)
+        self._apply_ham = make_hamiltonian_kernel(self.ham_terms,
+                                                  len(qubits),
+                                                  dtype=self.wf_dtype,
+                                                  use_gpu=use_gpu)
 
         # prepare logging if wished
         if enable_logging:
@@ -198,26 +308,29 @@ class PrepareAndMeasureOnWFSim(AbstractCostFunction):
         if nshots is None:
             nshots = self.nshots
 
-        memory_map = self.make_memory_map(params)
-        wf = self.sim.wavefunction(self.prepare_ansatz, memory_map)
-        E, E2 = wavefunction_expectation(self.hams_eigs, self.base_changes,
-                                         self.hams_squared_eigs,
-                                         self.base_changes_squared,
-                                         wf.amplitudes)
+        self._write_params(params)
+        wf = self.sim.wavefunction(self._bound_ansatz).amplitudes
+        wf = wf.astype(self.wf_dtype, copy=False)
+        # E = <psi|ham|psi> without an explicit conjugated copy of psi;
+        # np.vdot conjugates its first argument on the fly
+        Hw = self._apply_ham(wf)
+        E = np.vdot(wf, Hw).real
 
+        # the hamiltonian is hermitian, so <ham**2> = ||ham @ wf||**2 and
+        # no squared hamiltonian is needed for the noise estimate
         if nshots:
-            sigma_E = np.sqrt(
-                (E2 - E**2).real / nshots)
+            E2 = np.vdot(Hw, Hw).real
+            sigma_E = np.sqrt((E2 - E**2) / nshots)
+            E += np.random.randn() * sigma_E
         else:
             sigma_E = 0
 
-        E += np.random.randn() * sigma_E
         out = (E, sigma_E)  # Todo: Why the float casting?
 
         # Append function value and params to the log.
-        # deepcopy is needed, because x may be a mutable type.
+        # copy is needed, because x may be a mutable type.
         try:
-            self.log.append(LogEntry(x=deepcopy(params),
+            self.log.append(LogEntry(x=_copy_params(params),
                                      fun=out))
         except AttributeError:
             pass
@@ -227,6 +340,51 @@ class PrepareAndMeasureOnWFSim(AbstractCostFunction):
             return float(E)
         return out
 
+    def _update_memory(self, memory_map: Dict):
+        """Write ``memory_map`` into the MOVE instructions of the bound
+        ansatz program."""
+        for name, values in memory_map.items():
+            for offset, value in enumerate(values):
+                self._memory_moves[(name, offset)].right = value
+
+    def _write_params(self, params):
+        """Write ``params`` into the bound ansatz program, going through
+        ``make_memory_map`` only if no ``fast_memory_key`` is set."""
+        if self._fast_moves is not None:
+            for move, value in zip(self._fast_moves, params):
+                move.right = value
+        else:
+            self._update_memory(self.make_memory_map(params))
+
+    def batch(self,
+              params_list: Iterable) -> np.array:
+        """Evaluate the cost function at several parameter sets at once.
+
+        Useful e.g. for finite difference stencils, where the optimizer
+        evaluates the cost function at many nearly identical points per
+        gradient step. All evaluations share the bound ansatz program and
+        skip the logging and sampling noise of ``__call__``.
+
+        Parameters
+        ----------
+        params_list:
+            An iterable of parameter sets for the state preparation
+            circuit.
+
+        Returns
+        -------
+        np.array:
+            The energies, one per entry of ``params_list``.
+        """
+        energies = []
+        for params in params_list:
+            self._write_params(params)
+            wf = self.sim.wavefunction(self._bound_ansatz).amplitudes
+            wf = wf.astype(self.wf_dtype, copy=False)
+            Hw = self._apply_ham(wf)
+            energies.append(np.vdot(wf, Hw).real)
+        return np.array(energies)
+
     def get_wavefunction(self,
                          params: Union[List, np.ndarray]) -> Wavefunction:
         """Same as __call__ but returns the wavefunction instead of cost
@@ -241,8 +399,8 @@ class PrepareAndMeasureOnWFSim(AbstractCostFunction):
         Wavefunction:
             The wavefunction prepared with parameters ``params``
         """
-        memory_map = self.make_memory_map(params)
-        wf = self.sim.wavefunction(self.prepare_ansatz, memory_map=memory_map)
+        self._write_params(params)
+        wf = self.sim.wavefunction(self._bound_ansatz)
         return wf
 
 
@@ -282,6 +440,16 @@ class PrepareAndMeasureOnQVM(AbstractCostFunction):
         If true, a log is created which contains the parameter and function
         values at each function call. It is a list of namedtuples of the form
         ("x", "fun")
+    fast_memory_key:
+        If all parameters live in a single memory region (i.e.
+        ``make_memory_map`` would return ``{"params": params}``), pass
+        that region name here to reuse one memory map dict instead of
+        building a new one on every call.
+    n_threads:
+        Number of threads to sample the commuting groups with. Each run
+        is dominated by the round trip to the QVM, so threads give a
+        near-linear speedup in the number of groups. Defaults to 1,
+        i.e. sequential sampling.
     """
 
     def __init__(self,
@@ -294,11 +462,19 @@ class PrepareAndMeasureOnQVM(AbstractCostFunction):
                  base_numshots: int = 100,
                  qubit_mapping: Dict[QubitPlaceholder, Union[Qubit, int]] = None,
                  enable_logging: bool = False,
-                 hamiltonian_is_diagonal: bool =False):
+                 hamiltonian_is_diagonal: bool =False,
+                 fast_memory_key: str = None,
+                 n_threads: int = 1):
 
         self.scalar = scalar_cost_function
         self.nshots = nshots
         self.make_memory_map = make_memory_map
+        self.fast_memory_key = fast_memory_key
+        if fast_memory_key is not None:
+            self._fast_memory_map = {fast_memory_key: None}
+        else:
+            self._fast_memory_map = None
+        self.n_threads = n_threads
 
         if isinstance(qvm, str):
             qvm = get_qc(qvm)
@@ -311,11 +487,16 @@ class PrepareAndMeasureOnQVM(AbstractCostFunction):
             ham = hamiltonian
 
         if not hamiltonian_is_diagonal:
-            self.hams = commuting_decomposition(ham)
+            key = _hamiltonian_cache_key(ham)
+            try:
+                self.hams = _decomposition_cache[key]
+            except KeyError:
+                self.hams = commuting_decomposition(ham)
+                _cache_insert(_decomposition_cache, key, self.hams)
         else:
             self.hams = [ham]
 
-        self.exes = []
+        self.progs = []
         for ham in self.hams:
             # need a different program for each of the self commuting hams
             p = prepare_ansatz.copy()
@@ -323,11 +504,57 @@ class PrepareAndMeasureOnQVM(AbstractCostFunction):
                                     qubits=ham.get_qubits(),
                                     trials=base_numshots,
                                     ham=ham)
-            self.exes.append(qvm.compile(p))
+            self.progs.append(p)
+
+        self.base_numshots = base_numshots
+        # executables get ``base_numshots * nshots`` trials compiled in, so
+        # a single qvm.run returns all shots. They are cached per distinct
+        # nshots to avoid recompiling in the optimizer loop.
+        self._exes_by_nshots = {}
+        self.exes = self._executables(nshots)
+
+        # the QAM of a QuantumComputer is stateful (load/run/read), so
+        # concurrent sampling needs one QAM copy per commuting group
+        if n_threads > 1:
+            self._qams = [copy(qvm.qam) for _ in self.progs]
 
         if enable_logging:
             self.log = []
 
+    @staticmethod
+    def _run_single(qam, exe, memory_map) -> np.array:
+        """Same as ``QuantumComputer.run``, but on a dedicated QAM, so
+        that the commuting groups can be sampled concurrently."""
+        qam.load(exe)
+        if memory_map:
+            for region_name, values in memory_map.items():
+                qam.write_memory(region_name=region_name, value=values)
+        return qam.run().wait().read_memory(region_name="ro")
+
+    def _executables(self, nshots: int) -> List:
+        """Get the executables with ``base_numshots * nshots`` trials
+        compiled in, compiling and caching them on first use."""
+        try:
+            return self._exes_by_nshots[nshots]
+        except KeyError:
+            pass
+
+        exes = []
+        for prog in self.progs:
+            prog = prog.copy()
+            prog.wrap_in_numshots_loop(self.base_numshots * nshots)
+            # compilations are shared between instances via the module
+            # level cache, keyed by target QC, program text and numshots
+            key = (self.qvm.name, prog.out(), prog.num_shots)
+            try:
+                exe = _compile_cache[key]
+            except KeyError:
+                exe = self.qvm.compile(prog)
+                _cache_insert(_compile_cache, key, exe)
+            exes.append(exe)
+        self._exes_by_nshots[nshots] = exes
+        return exes
+
     def __call__(self,
                  params: np.array,
                  nshots: int = None) -> Union[float, Tuple]:
@@ -348,22 +575,28 @@ class PrepareAndMeasureOnQVM(AbstractCostFunction):
         if nshots is None:
             nshots = self.nshots
 
-        memory_map = self.make_memory_map(params)
-
-        bitstrings = []
-        for exe in self.exes:
-            bitstring = self.qvm.run(exe, memory_map=memory_map)
-            for i in range(nshots - 1):
-                new_bits = self.qvm.run(exe, memory_map=memory_map)
-                bitstring = np.append(bitstring, new_bits, axis=0)
-            bitstrings.append(bitstring)
+        if self.fast_memory_key is not None:
+            memory_map = self._fast_memory_map
+            memory_map[self.fast_memory_key] = params
+        else:
+            memory_map = self.make_memory_map(params)
+
+        exes = self._executables(nshots)
+        if self.n_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                bitstrings = list(executor.map(self._run_single,
+                                               self._qams, exes,
+                                               [memory_map] * len(exes)))
+        else:
+            bitstrings = [self.qvm.run(exe, memory_map=memory_map)
+                          for exe in exes]
 
         out = sampling_expectation(self.hams, bitstrings)
 
         # Append function value and params to the log.
-        # deepcopy is needed, because x may be a mutable type.
+        # copy is needed, because x may be a mutable type.
         try:
-            self.log.append(LogEntry(x=deepcopy(params),
+            self.log.append(LogEntry(x=_copy_params(params),
                                      fun=out))
         except AttributeError:
             pass
@@ -398,17 +631,19 @@ def address_qubits_hamiltonian(
     with for loops. It would be preferable to have this functionality in
     pyquil.paulis.PauliSum directly
     """
-    out = PauliTerm("I", 0, 0)
     # Make sure we map to integers and not to Qubits(), these are not
     # supported by pyquil.paulis.PauliSum().
     if set([Qubit]) == set(map(type, qubit_mapping.values())):
         qubit_mapping = dict(zip(qubit_mapping.keys(),
                                  [q.index for q in qubit_mapping.values()]))
-    # And change all of them
+    # And change all of them. Collect the remapped terms in a list first:
+    # summing them up with += re-simplifies the partial PauliSum on every
+    # addition, which is quadratic in the number of terms.
+    new_terms = []
     for term in hamiltonian:
         coeff = term.coefficient
         ops = []
         for factor in term:
             ops.append((factor[1], qubit_mapping[factor[0]]))
-        out += PauliTerm.from_list(ops, coeff)
-    return out
+        new_terms.append(PauliTerm.from_list(ops, coeff))
+    return PauliSum(new_terms).simplify()
@@ -56,6 +56,23 @@ from pyquil.quil import MEASURE, Program, QubitPlaceholder
 from pyquil.paulis import PauliSum, PauliTerm
 from pyquil.gates import H, I, RX
 
+# numba is an optional dependency. If it is installed, the expectation
+# value kernels get JIT compiled and parallelized, otherwise we fall
+# back to plain numpy.
+try:
+    from numba import njit, prange
+    _numba_available = True
+except ImportError:
+    _numba_available = False
+
+# cupy is an optional dependency as well. If it is installed, the
+# hamiltonian kernels can be evaluated on a GPU via ``use_gpu=True``.
+try:
+    import cupy as cp
+    _cupy_available = True
+except ImportError:
+    _cupy_available = False
+
 
 # ###########################################################################
 # Tools to decompose PauliSums into smaller PauliSums that can be measured
@@ -200,15 +217,22 @@ def sampling_expectation_z_base(hamiltonian: PauliSum,
     # This is neccesary, because hamiltonian might not act on all qubits.
     # E.g. if hamiltonian = X0 + 1.0*Z2 bitstrings is a 2 x numshots array
     index_lut = {q: i for (i, q) in enumerate(hamiltonian.get_qubits())}
-    if bitstrings.ndim == 2:
-        energies = np.zeros(bitstrings.shape[0])
-    else:
-        energies = np.array([0])
-    for term in hamiltonian:
-        sign = np.zeros_like(energies)
+    bitstrings = np.atleast_2d(np.asarray(bitstrings))
+
+    # one row per term, with a 1 in each column the term acts on. The
+    # sign of a term on a shot is then (-1)**parity of the masked bits,
+    # which gives all energies as two matrix products instead of a
+    # python loop over terms and factors.
+    masks = np.zeros((len(hamiltonian), bitstrings.shape[1]),
+                     dtype=bitstrings.dtype)
+    coeffs = np.empty(len(hamiltonian))
+    for t, term in enumerate(hamiltonian):
+        coeffs[t] = term.coefficient.real
         for factor in term:
-            sign += bitstrings[:, index_lut[factor[0]]]
-        energies += term.coefficient.real * (-1)**sign
+            masks[t, index_lut[factor[0]]] = 1
+
+    parities = bitstrings@masks.T
+    energies = (1 - 2 * (parities % 2))@coeffs
 
     return (np.mean(energies),
             np.var(energies) / (bitstrings.shape[0] - 1))
@@ -310,21 +334,32 @@ def base_change_fun(ham: PauliSum, qubits: List[int]) -> Callable:
     return out
 
 
+def _parities(ints: np.array) -> np.array:
+    """Calculate the bit parity (popcount mod 2) of each entry in ``ints``."""
+    ints = ints.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        ints ^= ints >> shift
+    return ints & 1
+
+
 def kron_eigs(ham: PauliSum, qubits: List[int]) -> np.array:
     """
     Calculate the eigenvalues of `ham` ordered as a tensorproduct
     on `qubits`. Each qubit should be acted on with the same operator
     by each term or not at all.
     """
+    # The eigenvalue of a Pauli product on the basis state |i> is
+    # (-1)^popcount(i & mask), where mask has a bit set for each qubit the
+    # term acts on. Calculating it this way needs only one pass over the
+    # diagonal per term, instead of a chain of 2**n sized np.kron products.
+    indices = np.arange(2**len(qubits))
     diag = np.zeros((2**len(qubits)))
     for term in ham:
-        out = term.coefficient.real
-        for qubit in qubits:
+        mask = 0
+        for i, qubit in enumerate(qubits):
             if term[qubit] != 'I':
-                out = np.kron([1, -1], out)
-            else:
-                out = np.kron([1, 1], out)
-        diag += out
+                mask |= 1 << i
+        diag += term.coefficient.real * (1 - 2 * _parities(indices & mask))
 
     return diag
 
@@ -371,3 +406,273 @@ def wavefunction_expectation(hams_eigs: List[np.array],
         energy2 += probs@eigs
 
     return (energy, energy2)
+
+
+def pauli_mask_terms(ham: PauliSum,
+                     qubits: List[int]) -> Tuple[np.array,
+                                                 np.array, np.array]:
+    """Extract a masked-index representation of all terms in ``ham``.
+
+    A Pauli product acts on a basis state as
+
+    .. math::
+
+        P \\left|i\\right> =
+            c \\, (-1)^{popcount(i \\, \\& \\, phase\\_mask)}
+            \\left|i \\oplus flip\\_mask \\right>
+
+    where ``flip_mask`` has a bit set for each qubit ``P`` acts on with X
+    or Y, ``phase_mask`` for each qubit with Z or Y and ``c`` collects one
+    factor ``1j`` per Y. With this representation expectation values can
+    be computed directly from the wavefunction, without building any
+    matrices or applying base changes.
+
+    Parameters
+    ----------
+    ham:
+        The hamiltonian to convert.
+    qubits:
+        The qubits the wavefunction lives on. ``qubits[0]`` corresponds
+        to the least significant bit of the wavefunction index.
+
+    Returns
+    -------
+    Tuple[np.array, np.array, np.array]:
+        The coefficients, flip masks and phase masks of all terms.
+    """
+    coeffs = np.zeros(len(ham), dtype=complex)
+    flip_masks = np.zeros(len(ham), dtype=int)
+    phase_masks = np.zeros(len(ham), dtype=int)
+    for t, term in enumerate(ham):
+        coeff = term.coefficient
+        flip, phase = 0, 0
+        for i, qubit in enumerate(qubits):
+            op = term[qubit]
+            if op in ('X', 'Y'):
+                flip |= 1 << i
+            if op in ('Z', 'Y'):
+                phase |= 1 << i
+            if op == 'Y':
+                coeff *= 1j
+        coeffs[t] = coeff
+        flip_masks[t] = flip
+        phase_masks[t] = phase
+
+    return coeffs, flip_masks, phase_masks
+
+
+if _numba_available:
+    @njit(parallel=True, fastmath=True)
+    def _apply_hamiltonian_kernel(coeffs, flip_masks, phase_masks, wf):
+        """JIT compiled inner loop of ``apply_hamiltonian_masks``."""
+        out = np.zeros_like(wf)
+        for t in range(coeffs.shape[0]):
+            coeff = coeffs[t]
+            flip = flip_masks[t]
+            phase = phase_masks[t]
+            for i in prange(wf.shape[0]):
+                j = i ^ flip
+                v = j & phase
+                v ^= v >> 32
+                v ^= v >> 16
+                v ^= v >> 8
+                v ^= v >> 4
+                v ^= v >> 2
+                v ^= v >> 1
+                out[i] += coeff * (1 - 2 * (v & 1)) * wf[j]
+        return out
+
+    @njit(parallel=True, fastmath=True)
+    def _pauli_expectation_kernel(coeffs, flip_masks, phase_masks, wf):
+        """JIT compiled inner loop of ``wavefunction_expectation_masks``.
+
+        Parallelizes over the terms and avoids materializing the index,
+        sign and gathered amplitude arrays of the numpy code path.
+        """
+        energy = 0.0
+        for t in prange(coeffs.shape[0]):
+            flip = flip_masks[t]
+            phase = phase_masks[t]
+            acc = 0.0 + 0.0j
+            for i in range(wf.shape[0]):
+                v = i & phase
+                v ^= v >> 32
+                v ^= v >> 16
+                v ^= v >> 8
+                v ^= v >> 4
+                v ^= v >> 2
+                v ^= v >> 1
+                sign = 1 - 2 * (v & 1)
+                acc += sign * np.conj(wf[i ^ flip]) * wf[i]
+            energy += (coeffs[t] * acc).real
+        return energy
+
+
+def apply_hamiltonian_masks(terms: Tuple[np.array, np.array, np.array],
+                            wf: np.array) -> np.array:
+    """Apply a hamiltonian to ``wf``, i.e. compute ``ham @ wf``.
+
+    Parameters
+    ----------
+    terms:
+        The masked-index representation of the hamiltonian, as produced
+        by ``pauli_mask_terms``.
+    wf:
+        The wavefunction to apply the hamiltonian to.
+
+    Returns
+    -------
+    np.array:
+        ``ham @ wf``, without ever building a matrix. Each term is one
+        gather-and-accumulate pass over ``wf``.
+    """
+    coeffs, flip_masks, phase_masks = terms
+    if wf.dtype not in (np.complex64, np.complex128):
+        wf = wf.astype(complex)
+    if _numba_available:
+        return _apply_hamiltonian_kernel(coeffs, flip_masks, phase_masks,
+                                         np.ascontiguousarray(wf))
+
+    indices = np.arange(len(wf))
+    out = np.zeros_like(wf)
+    for coeff, flip, phase in zip(coeffs, flip_masks, phase_masks):
+        signs = (1 - 2 * _parities(indices & phase)).astype(wf.real.dtype)
+        # P|i> = c*sign(i)|i ^ flip>, so entry i of P @ wf picks up the
+        # amplitude and sign at index i ^ flip
+        out += (coeff * signs * wf)[indices ^ flip]
+    return out
+
+
+def make_hamiltonian_kernel(terms: Tuple[np.array, np.array, np.array],
+                            n_qubits: int,
+                            dtype: type = np.complex128,
+                            use_gpu: bool = False) -> Callable:
+    """Build a function specialized to one hamiltonian computing ``ham @ wf``.
+
+    The gather indices and the (coefficient times sign) phase tables of
+    every term are evaluated once on the first call, so from then on the
+    returned function only performs gathers and multiply-adds. Worth it
+    whenever the same hamiltonian is applied many times, i.e. in every
+    optimizer run.
+
+    Parameters
+    ----------
+    terms:
+        The masked-index representation of the hamiltonian, as produced
+        by ``pauli_mask_terms``.
+    n_qubits:
+        The number of qubits the wavefunction lives on.
+    dtype:
+        The complex dtype to evaluate in. Defaults to ``np.complex128``.
+    use_gpu:
+        If ``True``, keep the phase tables and gather indices on the GPU
+        and evaluate there via cupy. The wavefunction is copied to the
+        device on each call and the result back, so this pays off once
+        the matvec itself dominates over the PCIe transfer, i.e. for
+        large qubit counts. Requires cupy to be installed.
+
+    Returns
+    -------
+    Callable:
+        A function ``apply_ham(wf) -> ham @ wf``. It writes into scratch
+        buffers owned by the closure, so the returned array is only
+        valid until the next call.
+    """
+    if use_gpu and not _cupy_available:
+        raise ImportError("use_gpu=True requires cupy to be installed")
+    xp = cp if use_gpu else np
+
+    coeffs, flip_masks, phase_masks = terms
+    # the tables are built lazily on the first call, so constructing a
+    # cost function costs O(n_terms) memory, not O(2**n_qubits)
+    tables = {}
+
+    def _build_tables():
+        indices = np.arange(2**n_qubits)
+
+        # Terms with the same flip mask gather from the same indices, so
+        # their phase tables can be summed into one. This leaves one
+        # pass over the wavefunction per _distinct_ flip mask; in
+        # particular all diagonal terms (e.g. a whole QAOA cost
+        # hamiltonian) collapse into a single fused diagonal.
+        fused = {}
+        for coeff, flip, phase in zip(coeffs, flip_masks, phase_masks):
+            table = coeff * (1 - 2 * _parities(indices & phase))
+            if flip in fused:
+                fused[flip] += table
+            else:
+                fused[flip] = table
+
+        # gather indices always fit the smallest unsigned int type and
+        # the all-diagonal pass needs no gather at all
+        index_dtype = np.min_scalar_type(2**n_qubits - 1)
+        tables["phases"] = [xp.asarray(table.astype(dtype))
+                            for table in fused.values()]
+        tables["gathers"] = [None if flip == 0
+                             else xp.asarray((indices ^ flip)
+                                             .astype(index_dtype))
+                             for flip in fused]
+
+        # persistent scratch buffers, so repeated calls don't allocate
+        # any 2**n sized temporaries. Note that this makes the returned
+        # array shared between calls.
+        tables["out"] = xp.empty(2**n_qubits, dtype=dtype)
+        tables["scratch"] = xp.empty(2**n_qubits, dtype=dtype)
+        tables["gathered"] = xp.empty(2**n_qubits, dtype=dtype)
+
+    def apply_ham(wf: np.array) -> np.array:
+        if not tables:
+            _build_tables()
+        wf = xp.asarray(wf)
+        out, scratch = tables["out"], tables["scratch"]
+        out.fill(0)
+        for phases, gather in zip(tables["phases"], tables["gathers"]):
+            xp.multiply(phases, wf, out=scratch)
+            if gather is None:
+                xp.add(out, scratch, out=out)
+            else:
+                xp.take(scratch, gather, out=tables["gathered"])
+                xp.add(out, tables["gathered"], out=out)
+        return out.get() if use_gpu else out
+
+    return apply_ham
+
+
+def wavefunction_expectation_masks(terms: Tuple[np.array,
+                                                np.array, np.array],
+                                   wf: np.array) -> float:
+    """Compute the expectation value of a hamiltonian w.r.t ``wf``.
+
+    Uses a JIT compiled kernel if numba is installed and plain numpy
+    otherwise.
+
+    Parameters
+    ----------
+    terms:
+        The masked-index representation of the hamiltonian, as produced
+        by ``pauli_mask_terms``.
+    wf:
+        The wavefunction whose expectation value we want to know.
+
+    Returns
+    -------
+    float:
+        The expectation value. Each term costs only a single strided
+        pass over ``wf``.
+    """
+    coeffs, flip_masks, phase_masks = terms
+    if wf.dtype not in (np.complex64, np.complex128):
+        wf = wf.astype(complex)
+    if _numba_available:
+        return _pauli_expectation_kernel(coeffs, flip_masks, phase_masks,
+                                         np.ascontiguousarray(wf))
+
+    indices = np.arange(len(wf))
+    energy = 0
+    for coeff, flip, phase in zip(coeffs, flip_masks, phase_masks):
+        # match the sign dtype to the wavefunction so complex64 input
+        # doesn't get promoted back to complex128
+        signs = (1 - 2 * _parities(indices & phase)).astype(wf.real.dtype)
+        energy += coeff * ((np.conj(wf[indices ^ flip]) * signs) @ wf)
+
+    return energy.real